@@ -1,27 +1,59 @@
-import json
+import hashlib
+import hmac
+import threading
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional, Tuple
 
 from . import config as cfg
 from .render import RenderError
 
+try:
+    import orjson as _json
+except ImportError:
+    # 没装 orjson 时退回标准库；json.loads 同样可以直接吃 bytes
+    import json as _json
 
-def _load_auth_json() -> Dict[str, str]:
+# (st_mtime_ns, {username: sha256(password)})；文件 mtime 不变就直接复用
+_AUTH_CACHE: Optional[Tuple[int, Dict[str, bytes]]] = None
+_AUTH_LOCK = threading.Lock()
+
+
+def _hash_password(password: str) -> bytes:
+    return hashlib.sha256(password.encode("utf-8")).digest()
+
+
+def _load_auth_json() -> Dict[str, bytes]:
     """
     从服务器上的明文 auth.json 读取用户信息
-    返回：{username: password}
+    返回：{username: sha256(password)}
+    按文件 mtime 缓存：auth.json 未改动时不再重复读取/解析
     """
+    global _AUTH_CACHE
     p: Path = cfg.AUTH_FILE
 
-    if not p.exists():
+    try:
+        st = p.stat()
+    except FileNotFoundError:
         raise RenderError(
             "AUTH_FILE_MISSING",
             "账号文件不存在",
             detail=str(p),
         )
 
+    with _AUTH_LOCK:
+        cached = _AUTH_CACHE
+        if cached is not None and cached[0] == st.st_mtime_ns:
+            return cached[1]
+
+        out = _parse_auth_json(p)
+        _AUTH_CACHE = (st.st_mtime_ns, out)
+        return out
+
+
+def _parse_auth_json(p: Path) -> Dict[str, bytes]:
+    """解析 auth.json，密码在载入时即转为 sha256 摘要。"""
     try:
-        data = json.loads(p.read_text(encoding="utf-8"))
+        data = _json.loads(p.read_bytes())
     except Exception as e:
         raise RenderError(
             "AUTH_FILE_BAD",
@@ -36,14 +68,14 @@ def _load_auth_json() -> Dict[str, str]:
             "auth.json 格式错误：缺少 users 列表",
         )
 
-    out: Dict[str, str] = {}
+    out: Dict[str, bytes] = {}
     for u in users:
         if not isinstance(u, dict):
             continue
         username = str(u.get("username", "")).strip()
         password = str(u.get("password", ""))
         if username:
-            out[username] = password
+            out[username] = _hash_password(password)
 
     return out
 
@@ -53,4 +85,8 @@ def verify_user(username: str, password: str) -> bool:
     登录校验函数（供 main.py 调用）
     """
     users = _load_auth_json()
-    return username in users and users[username] == password
+    expected = users.get(username)
+    if expected is None:
+        return False
+    # 常量时间比较，避免按字符提前返回泄露信息
+    return hmac.compare_digest(expected, _hash_password(password))
@@ -1,14 +1,23 @@
 # app/cache.py
 from __future__ import annotations
 
+import fcntl
+import heapq
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Iterable, List, Tuple, Optional
+from typing import Iterable, List, Set, Tuple, Optional
 
 from . import config as cfg
 
+# 配置在 import 时已由环境变量定型、运行期不会变：热路径直接用模块级常量
+_CACHE_MAX_BYTES: int = cfg.CACHE_MAX_BYTES
+_CACHE_DIRS: List[Path] = list(cfg.CACHE_DIRS)
+_LOCK_DIR: Path = cfg.LOCK_DIR
+
 
 @dataclass
 class CachePruneResult:
@@ -20,47 +29,153 @@ class CachePruneResult:
     skipped_due_to_lock: bool = False
 
 
-def _iter_files(dirs: Iterable[Path]) -> Iterable[Path]:
+def _scan_dir(path: str, out: List[Tuple[float, int, str]]) -> None:
+    try:
+        it = os.scandir(path)
+    except FileNotFoundError:
+        return
+    with it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    _scan_dir(entry.path, out)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    out.append((st.st_mtime, st.st_size, entry.path))
+            except FileNotFoundError:
+                # 并发情况下文件可能刚被删
+                continue
+
+
+def _scan(dirs: Iterable[Path]) -> List[Tuple[float, int, str]]:
+    """
+    一次遍历收集所有缓存文件的 (mtime, size, path)。
+    用 os.scandir 代替 rglob + stat，避免重复构造 Path 和重复 stat。
+    """
+    out: List[Tuple[float, int, str]] = []
     for d in dirs:
-        if not d.exists():
-            continue
-        for p in d.rglob("*"):
-            if p.is_file():
-                yield p
+        _scan_dir(os.fspath(d), out)
+    return out
+
+
+# -------- in-process size counter --------
+# 进程内近似记录缓存总大小，写入前据此判断是否需要清理，避免每次都全量扫描目录。
+# 其他进程写入 / 外部删除造成的偏差，靠每 _RESYNC_EVERY_WRITES 次写入全量扫描一次纠正。
+# 超过 max_bytes 才清理，且一次删到 max_bytes 的 _PRUNE_HEADROOM：留出余量，
+# 避免缓存满了以后每次写入都触发一轮扫描 + 删一个文件。
+_PRUNE_HEADROOM = 0.95
+_RESYNC_EVERY_WRITES = 200
+
+_approx_lock = threading.Lock()
+_approx_bytes: Optional[int] = None
+_writes_since_scan = 0
 
 
-def _total_size_bytes(dirs: Iterable[Path]) -> int:
-    total = 0
-    for p in _iter_files(dirs):
+def _sync_approx(total: int) -> None:
+    global _approx_bytes, _writes_since_scan
+    with _approx_lock:
+        _approx_bytes = total
+        _writes_since_scan = 0
+
+
+def _fresh_approx() -> Optional[int]:
+    """返回进程内计数；尚未初始化或写入次数达到阈值（需要全量扫描校正）时返回 None。"""
+    with _approx_lock:
+        if _approx_bytes is None or _writes_since_scan >= _RESYNC_EVERY_WRITES:
+            return None
+        return _approx_bytes
+
+
+def record_write(path: Path, size: Optional[int] = None) -> None:
+    """
+    缓存文件写入成功后调用，累加进程内计数。
+    size 为空时自动 stat 一次。
+    """
+    global _approx_bytes, _writes_since_scan
+    if size is None:
         try:
-            total += p.stat().st_size
+            size = os.stat(path).st_size
         except FileNotFoundError:
-            # 并发情况下文件可能刚被删
-            pass
-    return total
+            return
+    with _approx_lock:
+        if _approx_bytes is None:
+            # 尚未初始化：首次扫描时自然会把它算进去
+            return
+        _approx_bytes += size
+        _writes_since_scan += 1
+
+
+# -------- background prune --------
+_prune_thread: Optional[threading.Thread] = None
+_prune_thread_lock = threading.Lock()
+
+
+def prune_cache_in_background() -> None:
+    """
+    写入后调用：进程内计数超过上限（或需要重新校正）时，
+    在后台线程里执行 prune_cache_if_needed，不阻塞当前请求。
+    每个进程同一时刻最多一个后台清理线程。
+    """
+    global _prune_thread
+    max_bytes = _CACHE_MAX_BYTES
+    with _approx_lock:
+        approx = _approx_bytes
+        stale = approx is None or _writes_since_scan >= _RESYNC_EVERY_WRITES
+    if not stale and approx <= max_bytes:
+        return
+
+    with _prune_thread_lock:
+        if _prune_thread is not None and _prune_thread.is_alive():
+            return
+        _prune_thread = threading.Thread(target=prune_cache_if_needed, name="cache-prune", daemon=True)
+        _prune_thread.start()
+
+
+# -------- batched unlink --------
+# 网络盘 / 机械盘上单个 unlink 延迟高：按批并发删除，吞吐受限于文件系统并行度而非单次延迟
+_UNLINK_WORKERS = 8
+_UNLINK_BATCH = 256
+
+_unlink_pool = ThreadPoolExecutor(max_workers=_UNLINK_WORKERS, thread_name_prefix="cache-unlink")
+
+
+def _safe_unlink(path: str) -> Optional[bool]:
+    """删除单个文件：True=已删除，False=本就不存在，None=删不掉（权限/占用等）。"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        return False
+    except Exception:
+        return None
+    return True
 
 
 # -------- prune lock (global) --------
 def _acquire_prune_lock(lock_path: Path) -> Optional[int]:
     """
     Non-blocking lock. Returns fd if acquired, else None.
+    用 fcntl.flock 而不是 O_EXCL 建文件：锁文件常驻不删，进程退出 / 被杀（包括 daemon
+    清理线程来不及跑 finally）时内核随 fd 一并释放，不会留下让后续清理永远跳过的死锁文件。
     """
     try:
-        fd = os.open(str(lock_path), os.O_CREAT | os.O_EXCL | os.O_RDWR)
-        os.write(fd, f"pid={os.getpid()} time={time.time()}\n".encode("utf-8"))
-        return fd
-    except FileExistsError:
+        fd = os.open(str(lock_path), os.O_CREAT | os.O_RDWR, 0o644)
+    except FileNotFoundError:
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(str(lock_path), os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
         return None
+    except OSError:
+        os.close(fd)
+        raise
+    return fd
 
 
-def _release_prune_lock(fd: int, lock_path: Path) -> None:
-    try:
-        os.close(fd)
-    finally:
-        try:
-            lock_path.unlink(missing_ok=True)
-        except Exception:
-            pass
+def _release_prune_lock(fd: int) -> None:
+    # close 即释放 flock；锁文件保留复用
+    os.close(fd)
 
 
 def prune_cache_if_needed(
@@ -69,7 +184,8 @@ def prune_cache_if_needed(
     keep_newest: int = 0,
 ) -> CachePruneResult:
     """
-    若缓存目录总大小超过 max_bytes，则按 mtime 从旧到新删除文件，直到不超过 max_bytes。
+    若缓存目录总大小超过 max_bytes，则按 mtime 从旧到新删除文件，
+    直到不超过 max_bytes * _PRUNE_HEADROOM（留出余量，避免刚删完又超限）。
 
     参数：
     - max_bytes: 最大允许总字节数，默认 cfg.CACHE_MAX_BYTES
@@ -79,28 +195,37 @@ def prune_cache_if_needed(
     并发策略：
     - 使用一个全局 prune lock，避免多个请求同时大量删除。
     - 如果拿不到锁：直接跳过（不阻塞），返回 skipped_due_to_lock=True。
+
+    快速路径：
+    - 使用默认 dirs 时，先看进程内计数（见 record_write），
+      未超过 max_bytes 就直接返回，不触碰文件系统。
     """
     t0 = time.time()
     if max_bytes is None:
-        max_bytes = getattr(cfg, "CACHE_MAX_BYTES", 10 * 1024**3)
-    if dirs is None:
-        dirs = getattr(cfg, "CACHE_DIRS", [cfg.PNG_DIR, cfg.PDF_DIR, cfg.TIFF_DIR])
+        max_bytes = _CACHE_MAX_BYTES
+    use_counter = dirs is None
+    dirs = _CACHE_DIRS if dirs is None else list(dirs)
+
+    if use_counter:
+        approx = _fresh_approx()
+        if approx is not None and approx <= max_bytes:
+            return CachePruneResult(approx, approx, 0, 0, int((time.time() - t0) * 1000), False)
 
-    # 先算一遍大小（没超就直接返回）
-    before = _total_size_bytes(dirs)
+    # 扫一遍（没超就直接返回）；计数需要校正时也复用这一次扫描，扫描在锁外进行
+    entries = _scan(dirs)
+    before = sum(size for _, size, _ in entries)
+    if use_counter:
+        _sync_approx(before)
     if before <= max_bytes:
         return CachePruneResult(before, before, 0, 0, int((time.time() - t0) * 1000), False)
 
     # 全局清理锁（不阻塞）
-    cfg.LOCK_DIR.mkdir(parents=True, exist_ok=True)
-    lock_path = cfg.LOCK_DIR / "_prune.lock"
-    fd = _acquire_prune_lock(lock_path)
+    fd = _acquire_prune_lock(_LOCK_DIR / "_prune.lock")
     if fd is None:
         # 别人正在清理，跳过即可
-        now_bytes = _total_size_bytes(dirs)
         return CachePruneResult(
             before_bytes=before,
-            after_bytes=now_bytes,
+            after_bytes=before,
             deleted_files=0,
             deleted_bytes=0,
             elapsed_ms=int((time.time() - t0) * 1000),
@@ -111,48 +236,52 @@ def prune_cache_if_needed(
     deleted_bytes = 0
 
     try:
-        # 重新计算一次（拿到锁后可能已经被别人清理过）
-        current = _total_size_bytes(dirs)
-        if current <= max_bytes:
-            return CachePruneResult(before, current, 0, 0, int((time.time() - t0) * 1000), False)
-
-        # 收集 (mtime, size, path)
-        entries: List[Tuple[float, int, Path]] = []
-        for p in _iter_files(dirs):
-            try:
-                st = p.stat()
-                entries.append((st.st_mtime, st.st_size, p))
-            except FileNotFoundError:
-                pass
+        # 锁是非阻塞获取的：拿到即说明此刻没人在清理，直接复用上面的扫描结果。
+        # 扫描之后被别人删掉的文件，unlink 时按“已不存在”处理，照样从 current 扣除。
+        current = before
 
-        # 从旧到新
-        entries.sort(key=lambda x: x[0])
+        # 删到低水位，而不是刚好压线
+        target = max_bytes * _PRUNE_HEADROOM
 
+        # 保留最新 N 个文件不删
+        keep: Set[str] = set()
         if keep_newest > 0 and len(entries) > keep_newest:
-            deletable = entries[:-keep_newest]
-        else:
-            deletable = entries
+            keep = {path for _, _, path in heapq.nlargest(keep_newest, entries)}
 
-        for _, size, path in deletable:
-            if current <= max_bytes:
-                break
-            try:
-                path.unlink(missing_ok=True)
-                deleted_files += 1
-                deleted_bytes += size
+        # 最小堆按 mtime 从旧到新弹出；通常只超出一点点，无需对全部文件排序
+        heapq.heapify(entries)
+        while entries and current > target:
+            # 凑一批：预计删完刚好回到低水位以内（单批最多 _UNLINK_BATCH 个）
+            batch: List[Tuple[int, str]] = []
+            planned = 0
+            while entries and len(batch) < _UNLINK_BATCH and current - planned > target:
+                _, size, path = heapq.heappop(entries)
+                if path in keep:
+                    continue
+                batch.append((size, path))
+                planned += size
+
+            results = _unlink_pool.map(_safe_unlink, [path for _, path in batch])
+            for (size, path), res in zip(batch, results):
+                if res is None:
+                    # 权限/占用等删不掉就跳过；下一批会继续补删更新的文件
+                    continue
+                # 删掉或已被别人删掉，都不再占用配额
                 current -= size
-            except Exception:
-                # 权限/占用等删不掉就跳过
-                continue
+                if res:
+                    deleted_files += 1
+                    deleted_bytes += size
+
+        if use_counter:
+            _sync_approx(current)
 
-        after = _total_size_bytes(dirs)
         return CachePruneResult(
             before_bytes=before,
-            after_bytes=after,
+            after_bytes=current,
             deleted_files=deleted_files,
             deleted_bytes=deleted_bytes,
             elapsed_ms=int((time.time() - t0) * 1000),
             skipped_due_to_lock=False,
         )
     finally:
-        _release_prune_lock(fd, lock_path)
+        _release_prune_lock(fd)
@@ -3,7 +3,7 @@ from __future__ import annotations
 
 import os
 from pathlib import Path
-from typing import Iterable, Set
+from typing import Iterable, List, Optional, Set, Tuple
 
 
 # -------------------------
@@ -110,14 +110,27 @@ def ensure_runtime() -> None:
 # -------------------------
 # 其他可选：数据文件扫描（方便你在 main.py 里做下拉列表）
 # -------------------------
+# (DATA_DIR 的 st_mtime_ns, 排好序的文件名)；目录内增删文件会改变目录 mtime
+_H5AD_LIST_CACHE: Optional[Tuple[int, List[str]]] = None
+
+
 def list_h5ad_files() -> list[str]:
     """
     Return h5ad file names (not full path) under DATA_DIR.
     Example: ['sham.h5ad', 'MCAO_1d.h5ad', ...]
+    Cached by DATA_DIR mtime: only re-list the directory when it changes.
     """
-    if not DATA_DIR.exists():
+    global _H5AD_LIST_CACHE
+    try:
+        mtime_ns = DATA_DIR.stat().st_mtime_ns
+    except FileNotFoundError:
         return []
-    return sorted([p.name for p in DATA_DIR.glob("*.h5ad")])
+
+    cached = _H5AD_LIST_CACHE
+    if cached is None or cached[0] != mtime_ns:
+        cached = (mtime_ns, sorted([p.name for p in DATA_DIR.glob("*.h5ad")]))
+        _H5AD_LIST_CACHE = cached
+    return list(cached[1])
 
 # 缓存总上限：10 GiB
 CACHE_MAX_BYTES: int = int(_env_int("CACHE_MAX_GB", 10) * 1024**3)
@@ -1,21 +1,61 @@
 # app/render.py
 from __future__ import annotations
 
+import fcntl
+import functools
 import os
-import time
+import re
+import threading
+import zlib
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, Literal
-
-import scanpy as sc
-import squidpy as sq
-import matplotlib.pyplot as plt
+from typing import TYPE_CHECKING, Dict, Optional, Literal, Tuple
+
+if TYPE_CHECKING:
+    import h5py
+    import numpy as np
+    import pandas as pd
+    import scanpy as sc
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from matplotlib.lines import Line2D
+    from PIL import Image
+    from scipy.spatial import cKDTree
 
 from . import config as cfg
-from .cache import prune_cache_if_needed
+from .cache import prune_cache_in_background, record_write
 
 ExportKind = Literal["pdf", "tiff"]
 
+# 配置在 import 时已由环境变量定型、运行期不会变：热路径直接用模块级常量
+_PNG_DIR: Path = cfg.PNG_DIR
+_PDF_DIR: Path = cfg.PDF_DIR
+_TIFF_DIR: Path = cfg.TIFF_DIR
+_LOCK_DIR: Path = cfg.LOCK_DIR
+_ALLOWED_EXPORT_DPI = cfg.ALLOWED_EXPORT_DPI
+
+# 重依赖（scanpy / matplotlib / numpy ...）推迟到第一次绘图时才导入，见 _import_plot_deps
+_PLOT_DEPS_LOADED = False
+_PLOT_DEPS_LOCK = threading.Lock()
+
+# 每个线程复用一个 Figure，避免每次绘图都重新构建 figure/axes
+_tls = threading.local()
+
+# 固定边距代替 bbox_inches="tight"：tight 在保存时要多做一遍完整布局来量边界
+_FIG_MARGINS = dict(left=0.02, right=0.98, bottom=0.02, top=0.92)
+# 类别型着色时图例放在右侧，坐标轴右边界收到这里
+_LEGEND_RIGHT = 0.72
+
+# 渲染锁文件的分桶数（见 _lock_path）
+_LOCK_STRIPES = 1024
+
+# h5py 直读：每个打开文件的 chunk 缓存大小；CSR 矩阵按行块扫描的块大小
+_H5_RDCC_NBYTES = 32 << 20
+_CSR_BLOCK_ROWS = 8192
+
+# 文件名中不允许的字符（\w 即 Unicode 字母数字及 _，与 str.isalnum 一致）
+_UNSAFE_GENE_CHARS = re.compile(r"[^\w.-]")
+
 
 @dataclass(frozen=True)
 class RenderResult:
@@ -31,9 +71,63 @@ class RenderError(Exception):
     detail: Optional[str] = None
 
 
+class _MinimalReadUnsupported(Exception):
+    """h5ad 的结构超出 h5py 直读能处理的范围：回退到 scanpy 读取。"""
+
+
+@dataclass(frozen=True)
+class _LibMeta:
+    """每个 library 固定不变的绘图信息（与基因无关）。数组只读，被多个请求共享。"""
+    xy: np.ndarray  # (N, 2) 连续 float32，已筛到当前 library
+    mask: Optional[np.ndarray]  # 当前 library 在 obs 中的行；None 表示全部
+    spot_pitch: float  # 相邻 spot 的中心距（数据坐标单位），决定方块边长
+
+
+@dataclass(frozen=True)
+class _ScatterData:
+    """
+    单个基因的绘图数据（与输出格式 / dpi 无关），png/pdf/tiff 共用。
+    行顺序与 _LibMeta.xy 一致；数组只读，被多个请求共享。
+    """
+    values: np.ndarray  # (N,) float32；categories 非空时为类别编码
+    finite: Optional[np.ndarray]  # 有值的点；None 表示全部有值
+    vmin: float
+    vmax: float
+    categories: Optional[Tuple[str, ...]] = None
+
+
 # -----------------------------
 # utils
 # -----------------------------
+def _import_plot_deps() -> None:
+    """
+    首次需要时才导入绘图相关的重依赖，并绑定为模块全局名。
+    应用启动、只返回已缓存文件的请求都不必付出数秒的导入开销。
+    """
+    global _PLOT_DEPS_LOADED, h5py, np, pd, sc, FigureCanvasAgg, Figure, Line2D, Image, cKDTree
+    if _PLOT_DEPS_LOADED:
+        return
+    with _PLOT_DEPS_LOCK:
+        if _PLOT_DEPS_LOADED:
+            return
+        import matplotlib
+
+        # 服务端无显示设备：在 scanpy 引入 pyplot 之前固定为 Agg
+        matplotlib.use("Agg")
+
+        import h5py
+        import numpy as np
+        import pandas as pd
+        import scanpy as sc
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        from matplotlib.lines import Line2D
+        from PIL import Image
+        from scipy.spatial import cKDTree
+
+        _PLOT_DEPS_LOADED = True
+
+
 def _safe_gene(gene: str) -> str:
     """
     你要求文件名用“基因名”：
@@ -43,7 +137,7 @@ def _safe_gene(gene: str) -> str:
     gene = (gene or "").strip()
     if not gene:
         raise RenderError("BAD_INPUT", "gene 不能为空。")
-    return "".join(ch if (ch.isalnum() or ch in "._-") else "_" for ch in gene)
+    return _UNSAFE_GENE_CHARS.sub("_", gene)
 
 
 def _pick_default_library() -> str:
@@ -59,11 +153,12 @@ def _pick_default_library() -> str:
     if not cfg.DATA_DIR.exists():
         raise RenderError("FILE_NOT_FOUND", "DATA_DIR 不存在。", detail=str(cfg.DATA_DIR))
 
-    files = sorted(cfg.DATA_DIR.glob("*.h5ad"))
+    # 按目录 mtime 缓存的列表，避免每个请求都 glob 一次
+    files = cfg.list_h5ad_files()
     if not files:
         raise RenderError("FILE_NOT_FOUND", "DATA_DIR 下没有任何 .h5ad 文件。", detail=str(cfg.DATA_DIR))
 
-    return files[0].stem  # filename without suffix
+    return Path(files[0]).stem  # filename without suffix
 
 
 def _adata_path(library: str) -> Path:
@@ -73,45 +168,89 @@ def _adata_path(library: str) -> Path:
     return p
 
 
+def _flock_wait(fd: int, op: int, timeout_s: float) -> bool:
+    """
+    在后台线程里阻塞等待 flock，由内核在锁释放时唤醒，不再轮询。
+    返回 True 表示已拿到锁；返回 False 时 fd 已不归调用方所有：
+    超时后由后台线程在拿到锁后立即关闭（即释放），其他失败在这里关闭。
+    """
+    guard = threading.Lock()
+    done = threading.Event()
+    state = {"acquired": False, "abandoned": False}
+
+    def _wait() -> None:
+        try:
+            fcntl.flock(fd, op)
+            ok = True
+        except OSError:
+            ok = False
+        with guard:
+            if state["abandoned"]:
+                os.close(fd)
+                return
+            state["acquired"] = ok
+            done.set()
+
+    threading.Thread(target=_wait, name="flock-wait", daemon=True).start()
+    done.wait(timeout_s)
+
+    with guard:
+        if not done.is_set():
+            state["abandoned"] = True
+            return False
+    if not state["acquired"]:
+        os.close(fd)
+    return state["acquired"]
+
+
 class _FileLock:
     """
-    基于 O_EXCL 的简易文件锁，避免并发重复绘图。
+    基于 fcntl.flock 的文件锁，避免并发重复绘图。
+    - 锁文件常驻、不删除（删除会让排队者锁在已失效的 inode 上）
+    - 有人持锁时由内核唤醒等待者，没有轮询间隔带来的延迟
+    - 进程崩溃时内核自动释放，不会留下死锁文件
     注意：锁目录 cfg.LOCK_DIR 由 cfg.ensure_runtime() 创建；这里也做兜底 mkdir。
     """
 
-    def __init__(self, lock_path: Path, timeout_s: float = 600.0, poll_s: float = 0.2):
+    def __init__(self, lock_path: Path, timeout_s: float = 600.0):
         self.lock_path = lock_path
         self.timeout_s = timeout_s
-        self.poll_s = poll_s
         self._fd: Optional[int] = None
 
+    def _acquire(self, op: int) -> None:
+        try:
+            fd = os.open(str(self.lock_path), os.O_CREAT | os.O_RDWR, 0o644)
+        except FileNotFoundError:
+            # 锁目录还不存在时才 mkdir，命中路径上不做多余的系统调用
+            self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(str(self.lock_path), os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(fd, op | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # 被占用：交给 _flock_wait 阻塞等待（fd 所有权随之转移）
+            if not _flock_wait(fd, op, self.timeout_s):
+                raise RenderError(
+                    "LOCK_TIMEOUT",
+                    "当前任务排队超时（可能同一张图正在被生成）。",
+                    detail=str(self.lock_path),
+                )
+        except OSError:
+            os.close(fd)
+            raise
+        self._fd = fd
+
     def acquire(self) -> None:
-        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
-        start = time.time()
-        while True:
-            try:
-                self._fd = os.open(str(self.lock_path), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-                os.write(self._fd, f"pid={os.getpid()} time={time.time()}\n".encode("utf-8"))
-                return
-            except FileExistsError:
-                if time.time() - start > self.timeout_s:
-                    raise RenderError(
-                        "LOCK_TIMEOUT",
-                        "当前任务排队超时（可能同一张图正在被生成）。",
-                        detail=str(self.lock_path),
-                    )
-                time.sleep(self.poll_s)
+        self._acquire(fcntl.LOCK_EX)
+
+    def acquire_shared(self) -> None:
+        """共享（读）锁：多个读者可并存，只与持排他锁的写入者互斥。"""
+        self._acquire(fcntl.LOCK_SH)
 
     def release(self) -> None:
-        try:
-            if self._fd is not None:
-                os.close(self._fd)
-        finally:
-            self._fd = None
-            try:
-                self.lock_path.unlink(missing_ok=True)
-            except Exception:
-                pass
+        # close 即释放 flock；锁文件保留复用
+        if self._fd is not None:
+            fd, self._fd = self._fd, None
+            os.close(fd)
 
     def __enter__(self):
         self.acquire()
@@ -122,20 +261,40 @@ class _FileLock:
         return False
 
 
-def _load_adata(*, library: str, layer: str) -> sc.AnnData:
-    adata = sc.read(_adata_path(library).as_posix())
+@functools.lru_cache(maxsize=4)
+def _load_adata_cached(library: str, layer: str, mtime_ns: int) -> sc.AnnData:
+    """
+    按 (library, layer, mtime_ns) 缓存读入的 AnnData；h5ad 被替换后 mtime 变化即自动失效。
+    整体读进内存、不用 backed="r"：缓存条目会跨请求存活，backed 对象会一直占着 HDF5 句柄，
+    原地重写 h5ad 时会因文件锁失败（并可能把文件截断）。
+    注意：返回的对象被多个请求共享，调用方不要修改它。
+    """
+    _import_plot_deps()
+    adata = sc.read_h5ad(_adata_path(library).as_posix())
 
     # layer="X" 表示直接用 adata.X
-    if layer != "X":
-        if layer not in adata.layers:
-            raise RenderError(
-                "LAYER_NOT_FOUND",
-                f"layer 不存在：{layer}",
-                detail=f"available_layers={list(adata.layers.keys())}",
-            )
-        adata = adata.copy()
-        adata.X = adata.layers[layer]
-    return adata
+    if layer == "X":
+        return adata
+
+    if layer not in adata.layers:
+        raise RenderError(
+            "LAYER_NOT_FOUND",
+            f"layer 不存在：{layer}",
+            detail=f"available_layers={list(adata.layers.keys())}",
+        )
+    # 搭一个轻量壳：obs/var/obsm 只引用不复制，X 用选中的 layer，原 X 随 adata 一起释放
+    return sc.AnnData(
+        X=adata.layers[layer],
+        obs=adata.obs,
+        var=adata.var,
+        obsm=dict(adata.obsm),
+        uns=adata.uns,
+        raw=adata.raw,
+    )
+
+
+def _adata_mtime_ns(library: str) -> int:
+    return _adata_path(library).stat().st_mtime_ns
 
 
 def _check_gene_exists(adata: sc.AnnData, gene: str) -> None:
@@ -150,15 +309,275 @@ def _check_gene_exists(adata: sc.AnnData, gene: str) -> None:
         )
 
 
-def _default_point_size(n_obs: int) -> float:
-    # 你的数据 8-9 万 spots，30 左右更合适
-    if n_obs <= 30_000:
-        return 50.0
-    if n_obs <= 80_000:
-        return 30.0
-    if n_obs <= 150_000:
-        return 18.0
-    return 10.0
+def _expression_column(adata: sc.AnnData, gene: str) -> np.ndarray:
+    """
+    取单个基因的表达列（优先 var，其次 raw），返回 1-D 连续 float32 数组。
+    提前转好 dtype，matplotlib 做颜色映射时不用再 densify + 升 float64。
+    """
+    if gene in adata.var_names:
+        x = adata[:, [gene]].X
+    else:
+        x = adata.raw[:, [gene]].X
+    if hasattr(x, "toarray"):
+        x = x.toarray()
+    x = np.asarray(x).ravel().astype(np.float32, copy=False)
+    return np.ascontiguousarray(x)
+
+
+def _obs_column(adata: sc.AnnData, gene: str) -> Tuple[np.ndarray, Optional[Tuple[str, ...]]]:
+    """obs 列：数值型直接转 float32；其他按类别编码（缺失为 NaN）。"""
+    col = adata.obs[gene]
+    if pd.api.types.is_numeric_dtype(col) and not isinstance(col.dtype, pd.CategoricalDtype):
+        return col.to_numpy(dtype=np.float32), None
+    cat = col.astype("category")
+    codes = cat.cat.codes.to_numpy().astype(np.float32)
+    codes[codes < 0] = np.nan
+    return codes, tuple(str(c) for c in cat.cat.categories)
+
+
+def _readonly(a: np.ndarray) -> np.ndarray:
+    a = np.ascontiguousarray(a)
+    a.setflags(write=False)
+    return a
+
+
+# -----------------------------
+# h5py minimal reader
+# -----------------------------
+# 绘图只需要 obsm[basis]、obs["library"] 和一列表达量：直接用 h5py 读这几块，
+# 不经 scanpy 解析整个 h5ad。结构不认识时抛 _MinimalReadUnsupported，由调用方回退。
+def _h5_open(library: str) -> h5py.File:
+    return h5py.File(_adata_path(library).as_posix(), "r", rdcc_nbytes=_H5_RDCC_NBYTES)
+
+
+def _h5_attr_str(obj, name: str, default: Optional[str] = None) -> Optional[str]:
+    v = obj.attrs.get(name, default)
+    return v.decode("utf-8") if isinstance(v, bytes) else v
+
+
+def _h5_strings(ds: h5py.Dataset) -> np.ndarray:
+    if h5py.check_string_dtype(ds.dtype) is None:
+        raise _MinimalReadUnsupported(f"not a string dataset: {ds.name}")
+    return ds.asstr()[:]
+
+
+@functools.lru_cache(maxsize=16)
+def _h5_var_index(library: str, mtime_ns: int, group: str) -> Optional[Dict[str, int]]:
+    """按 (library, mtime_ns) 缓存 var 名 -> 列号；group 为 "var" 或 "raw/var"，不存在时返回 None。"""
+    with _h5_open(library) as f:
+        var = f.get(group)
+        if var is None:
+            return None
+        if not isinstance(var, h5py.Group):
+            raise _MinimalReadUnsupported(f"{group} is not a group")
+        names = _h5_strings(var[_h5_attr_str(var, "_index", "_index")])
+    return {name: i for i, name in enumerate(names)}
+
+
+def _h5_library_mask(f: h5py.File, library: str) -> Optional[np.ndarray]:
+    """obs["library"] == library 的布尔掩码；没有这一列时返回 None。"""
+    obs = f["obs"]
+    if "library" not in obs:
+        return None
+    elem = obs["library"]
+    if isinstance(elem, h5py.Group):
+        # anndata >= 0.8 的 categorical
+        cats, codes = _h5_strings(elem["categories"]), elem["codes"][:]
+    elif "categories" in elem.attrs:
+        # 旧版 categorical：categories 存在 obs/__categories 下，attrs 里是引用
+        cats, codes = _h5_strings(f[elem.attrs["categories"]]), elem[:]
+    else:
+        return _h5_strings(elem) == library
+    hit = np.flatnonzero(cats == library)
+    if hit.size == 0:
+        return np.zeros(codes.shape[0], dtype=bool)
+    return codes == hit[0]
+
+
+def _h5_matrix_column(elem, idx: int) -> np.ndarray:
+    """从 dense / csc / csr 矩阵中取第 idx 列，返回 1-D float32。"""
+    if isinstance(elem, h5py.Dataset):
+        if elem.ndim != 2:
+            raise _MinimalReadUnsupported(f"unexpected matrix shape: {elem.shape}")
+        return np.asarray(elem[:, idx], dtype=np.float32)
+
+    enc = _h5_attr_str(elem, "encoding-type") or _h5_attr_str(elem, "h5sparse_format")
+    shape = elem.attrs.get("shape", elem.attrs.get("h5sparse_shape"))
+    if shape is None:
+        raise _MinimalReadUnsupported(f"sparse matrix without shape: {elem.name}")
+    out = np.zeros(int(shape[0]), dtype=np.float32)
+    indptr_ds, indices_ds, data_ds = elem["indptr"], elem["indices"], elem["data"]
+
+    if enc in ("csc_matrix", "csc"):
+        lo, hi = int(indptr_ds[idx]), int(indptr_ds[idx + 1])
+        if hi > lo:
+            out[indices_ds[lo:hi]] = data_ds[lo:hi]
+        return out
+
+    if enc in ("csr_matrix", "csr"):
+        # 按行块扫描 indices，内存占用与块大小相关而不是 nnz
+        indptr = indptr_ds[:]
+        n_rows = out.shape[0]
+        for r0 in range(0, n_rows, _CSR_BLOCK_ROWS):
+            r1 = min(r0 + _CSR_BLOCK_ROWS, n_rows)
+            lo, hi = int(indptr[r0]), int(indptr[r1])
+            if hi == lo:
+                continue
+            hit = np.flatnonzero(indices_ds[lo:hi] == idx)
+            if hit.size == 0:
+                continue
+            pos = lo + hit
+            rows = np.searchsorted(indptr[r0 : r1 + 1], pos, side="right") - 1 + r0
+            # 只读命中的那几个元素（pos 严格递增，h5py 可直接做点选），不读整块 data
+            out[rows] = data_ds[pos]
+        return out
+
+    raise _MinimalReadUnsupported(f"unsupported matrix encoding: {enc}")
+
+
+def _read_minimal_coords(library: str, basis: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """h5py 直读 obsm[basis] 与 library 掩码。"""
+    try:
+        with _h5_open(library) as f:
+            xy = np.asarray(f["obsm"][basis][:, :2], dtype=np.float32)
+            mask = _h5_library_mask(f, library)
+    except (KeyError, TypeError, ValueError) as e:
+        raise _MinimalReadUnsupported(repr(e)) from e
+    return xy, mask
+
+
+def _read_minimal_gene(library: str, gene: str, layer: str, mtime_ns: int) -> np.ndarray:
+    """
+    h5py 直读单个基因（优先 var，其次 raw）的整列表达量。
+    gene 只在 obs 里、layer 不存在等情况都交给 scanpy 路径处理（含报错）。
+    """
+    try:
+        idx = (_h5_var_index(library, mtime_ns, "var") or {}).get(gene)
+        if idx is not None:
+            path = "X" if layer == "X" else f"layers/{layer}"
+        else:
+            idx = (_h5_var_index(library, mtime_ns, "raw/var") or {}).get(gene)
+            if idx is None:
+                raise _MinimalReadUnsupported(f"gene not in var/raw: {gene}")
+            path = "raw/X"
+
+        with _h5_open(library) as f:
+            if path not in f:
+                raise _MinimalReadUnsupported(f"missing matrix: {path}")
+            return _h5_matrix_column(f[path], idx)
+    except (KeyError, TypeError, ValueError) as e:
+        raise _MinimalReadUnsupported(repr(e)) from e
+
+
+@functools.lru_cache(maxsize=8)
+def _lib_meta(library: str, layer: str, basis: str, mtime_ns: int) -> _LibMeta:
+    """
+    按 library 缓存坐标与默认点大小：换基因时不再重复取 obsm、转 dtype、算点大小。
+    优先 h5py 直读，结构不认识时回退到 scanpy。
+    """
+    try:
+        xy, m = _read_minimal_coords(library, basis)
+    except _MinimalReadUnsupported:
+        adata = _load_adata_cached(library, layer, mtime_ns)
+        xy = np.asarray(adata.obsm[basis])[:, :2].astype(np.float32, copy=False)
+        m = (adata.obs["library"] == library).to_numpy() if "library" in adata.obs.columns else None
+
+    # 一个 h5ad 里可能有多个 library：只画当前这个
+    mask = None
+    if m is not None and m.any() and not m.all():
+        mask = _readonly(m)
+        xy = xy[m]
+
+    return _LibMeta(xy=_readonly(xy), mask=mask, spot_pitch=_spot_pitch(xy))
+
+
+@functools.lru_cache(maxsize=64)
+def _render_artist(library: str, gene: str, layer: str, basis: str, mtime_ns: int) -> _ScatterData:
+    """
+    按 (library, gene, layer, basis, mtime_ns) 缓存绘图数据：
+    同一基因画过一次后，导出 pdf / 其他 dpi 的 tiff 不再读 h5ad。
+    优先 h5py 只读这一列，结构不认识（或 gene 在 obs 里）时回退到 scanpy。
+    """
+    try:
+        values, categories = _read_minimal_gene(library, gene, layer, mtime_ns), None
+    except _MinimalReadUnsupported:
+        adata = _load_adata_cached(library, layer, mtime_ns)
+        _check_gene_exists(adata, gene)
+
+        in_var = gene in adata.var_names
+        in_raw = (adata.raw is not None) and (gene in adata.raw.var_names)
+        if in_var or in_raw:
+            values, categories = _expression_column(adata, gene), None
+        else:
+            values, categories = _obs_column(adata, gene)
+
+    meta = _lib_meta(library, layer, basis, mtime_ns)
+    if meta.mask is not None:
+        values = values[meta.mask]
+
+    finite = ~np.isnan(values)
+    if finite.any():
+        vmin, vmax = float(values[finite].min()), float(values[finite].max())
+    else:
+        vmin, vmax = 0.0, 1.0
+
+    return _ScatterData(
+        values=_readonly(values),
+        finite=None if finite.all() else _readonly(finite),
+        vmin=vmin,
+        vmax=vmax,
+        categories=categories,
+    )
+
+
+def _thread_figure() -> Figure:
+    """
+    取当前线程复用的 Figure。
+    直接用 matplotlib.figure.Figure 而不是 plt.figure：不进 pyplot 的全局注册表，线程间互不干扰。
+    """
+    fig = getattr(_tls, "fig", None)
+    if fig is None:
+        fig = Figure(figsize=(5, 5))
+        FigureCanvasAgg(fig)
+        _tls.fig = fig
+    return fig
+
+
+def _spot_pitch(xy: np.ndarray) -> float:
+    """
+    相邻 spot 的典型中心距：最近邻距离的中位数（忽略重合点）。
+    方块边长按它换算，点大小跟着数据的实际间距走，不会互相重叠或留缝。
+    """
+    if len(xy) < 2:
+        return 1.0
+    dist, _ = cKDTree(xy).query(xy, k=2)
+    nn = dist[:, 1]
+    nn = nn[nn > 0]
+    return float(np.median(nn)) if nn.size else 1.0
+
+
+def _category_colors(n: int) -> list:
+    """与 scanpy 默认一致的定性调色板：<=20 类用 default_20，<=28 用 default_28，否则 default_102。"""
+    palettes = sc.pl.palettes
+    if n <= 20:
+        colors = palettes.default_20
+    elif n <= 28:
+        colors = palettes.default_28
+    else:
+        colors = palettes.default_102
+    return [colors[i % len(colors)] for i in range(n)]
+
+
+def _fit_spot_size(fig: Figure, ax, pitch: float) -> float:
+    """
+    把“边长 = pitch 个数据单位”的方块换算成 scatter 的 s（points²）。
+    需在坐标范围、等比例与 colorbar 都设好之后调用；用英寸换算，与保存 dpi 无关。
+    """
+    ax.apply_aspect()
+    width_in = ax.get_position().width * fig.get_figwidth()
+    x0, x1 = ax.get_xlim()
+    side_pt = pitch * width_in * 72.0 / abs(x1 - x0)
+    return side_pt * side_pt
 
 
 def _draw(
@@ -173,48 +592,131 @@ def _draw(
 ) -> None:
     """
     真正绘图并保存。
-    注意：清理缓存（prune）应在调用 _draw 前完成，避免“刚写完又被清掉”的竞态。
+    调用方需持有该输出文件的排他锁；缓存清理在写入后由后台线程按需触发。
     """
-    adata = _load_adata(library=library, layer=layer)
-    _check_gene_exists(adata, gene)
+    _import_plot_deps()
+    mtime_ns = _adata_mtime_ns(library)
+    meta = _lib_meta(library, layer, basis, mtime_ns)
+    data = _render_artist(library, gene, layer, basis, mtime_ns)
 
     out_path.parent.mkdir(parents=True, exist_ok=True)
 
-    fig, ax = plt.subplots(1, 1, figsize=(5, 5))
+    fig = _thread_figure()
+    # fig.clear() 会把 subplotpars 恢复成默认值：每次绘图都重新设定边距
+    fig.subplots_adjust(**_FIG_MARGINS)
+    ax = fig.add_subplot(111)
     try:
-        size = _default_point_size(adata.n_obs)
-
-        # squidpy spatial scatter
-        sq.pl.spatial_scatter(
-            adata,
-            color=gene,
-            spatial_key=basis,
-            library_key="library",
-            library_id=[library],
-            title=f"{library}_{gene}",
-            img=False,
-            shape="square",
-            size=size,
-            alpha=1.0,
-            na_color="lightgray",
-            frameon=False,
-            # legend_loc=None,
-            cmap="viridis",
-            ax=ax,
-            fig=fig,
-        )
+        # 先用占位大小画，等版面确定后再按 spot 间距统一设置方块大小
+        kw = dict(s=1.0, marker="s", linewidths=0)
+
+        # 常见情况（全部有值）直接用缓存的坐标，不做任何索引拷贝
+        xy, values = meta.xy, data.values
+        if data.finite is not None:
+            na = ~data.finite
+            ax.scatter(xy[na, 0], xy[na, 1], c="lightgray", **kw)
+            xy, values = xy[data.finite], values[data.finite]
+
+        if data.categories is None:
+            artist = ax.scatter(
+                xy[:, 0],
+                xy[:, 1],
+                c=values,
+                cmap="viridis",
+                vmin=data.vmin,
+                vmax=data.vmax,
+                **kw,
+            )
+            fig.colorbar(artist, ax=ax)
+        else:
+            colors = _category_colors(len(data.categories))
+            for i, color in enumerate(colors):
+                m = values == i
+                ax.scatter(xy[m, 0], xy[m, 1], color=color, **kw)
+            # 图例放在坐标轴右侧，不压住组织；右边距让出位置
+            fig.subplots_adjust(right=_LEGEND_RIGHT)
+            handles = [
+                Line2D([], [], marker="s", linestyle="", color=color, markersize=6, label=name)
+                for name, color in zip(data.categories, colors)
+            ]
+            ax.legend(
+                handles=handles,
+                loc="center left",
+                bbox_to_anchor=(1.02, 0.5),
+                fontsize="small",
+                frameon=False,
+            )
+
+        # 与空间坐标 / 图像坐标一致：y 轴向下，等比例，不画边框
+        ax.set_title(f"{library}_{gene}")
+        ax.set_aspect("equal")
+        ax.set_axis_off()
+        if len(meta.xy):
+            half = meta.spot_pitch / 2
+            ax.set_xlim(float(meta.xy[:, 0].min()) - half, float(meta.xy[:, 0].max()) + half)
+            ax.set_ylim(float(meta.xy[:, 1].max()) + half, float(meta.xy[:, 1].min()) - half)
+            size = _fit_spot_size(fig, ax, meta.spot_pitch)
+            for coll in ax.collections:
+                coll.set_sizes([size])
 
         # pdf 非栅格化；png/tiff 可栅格化减小体积
         ax.set_rasterized(fmt in ("png", "tiff"))
 
+        # 显式传整张 figure 的范围，不受 rcParams["savefig.bbox"] 影响，也不做 tight 重算
         if fmt == "pdf":
-            fig.savefig(out_path.as_posix(), bbox_inches="tight")
+            fig.savefig(out_path.as_posix(), bbox_inches=fig.bbox_inches)
         else:
             if dpi is None or int(dpi) <= 0:
                 raise RenderError("BAD_INPUT", "dpi 必须为正整数。", detail=f"dpi={dpi}")
-            fig.savefig(out_path.as_posix(), dpi=int(dpi), bbox_inches="tight", format=fmt)
+            _save_raster(fig, out_path, fmt=fmt, dpi=int(dpi))
     finally:
-        plt.close(fig)
+        # 清空后留给本线程下次复用，不 close
+        fig.clear()
+
+    # 更新进程内缓存大小计数，供 prune_cache_if_needed 快速判断
+    record_write(out_path)
+
+
+def _save_raster(fig: Figure, out_path: Path, *, fmt: Literal["png", "tiff"], dpi: int) -> None:
+    """
+    Agg 栅格化一次，直接把 RGBA 缓冲交给 Pillow 编码：
+    - png：compress_level=1（比默认 6 快得多，文件略大）
+    - tiff：LZW 压缩
+    """
+    prev_dpi = fig.dpi
+    fig.set_dpi(dpi)
+    try:
+        fig.canvas.draw()
+        img = Image.fromarray(np.asarray(fig.canvas.buffer_rgba()), "RGBA")
+        if fmt == "png":
+            img.save(out_path.as_posix(), "PNG", compress_level=1, dpi=(dpi, dpi))
+        else:
+            img.save(out_path.as_posix(), "TIFF", compression="tiff_lzw", dpi=(dpi, dpi))
+    finally:
+        fig.set_dpi(prev_dpi)
+        # Agg canvas 会缓存上一次的 renderer（1200 dpi 时约 144 MB）：
+        # 换一个新 canvas 丢掉它，避免每个复用 figure 的线程长期占着这块内存
+        FigureCanvasAgg(fig)
+
+
+def _lock_path(key: str) -> Path:
+    """
+    输出文件 -> 锁文件：按 crc32 分到固定数量的锁文件上（跨进程稳定）。
+    锁文件常驻不删，分桶让它们的数量有上限，而不是每个基因 / 格式各留一个。
+    """
+    return _LOCK_DIR / f"render_{zlib.crc32(key.encode('utf-8')) % _LOCK_STRIPES:04d}.lock"
+
+
+def _is_cached(lock_path: Path, out_path: Path) -> bool:
+    """
+    命中检查：持共享锁看文件是否存在。
+    写入者生成期间持排他锁，这里不会把写了一半的文件当成命中。
+    """
+    lock = _FileLock(lock_path)
+    lock.acquire_shared()
+    try:
+        return os.path.exists(out_path)
+    finally:
+        lock.release()
 
 
 # -----------------------------
@@ -237,19 +739,17 @@ def ensure_plot_png(
     gene = _safe_gene(gene)
     library = library or _pick_default_library()
 
-    out_path = cfg.PNG_DIR / f"{library}__{gene}.png"
-    lock_path = cfg.LOCK_DIR / f"{library}__{gene}.plot_png.lock"
+    out_path = _PNG_DIR / f"{library}__{gene}.png"
+    lock_path = _lock_path(f"{library}__{gene}.plot_png")
 
-    if out_path.exists():
+    if _is_cached(lock_path, out_path):
         return RenderResult(gene=gene, out_path=out_path, cache_hit=True)
 
     with _FileLock(lock_path):
+        # 排他锁内用真实 exists()：释放共享锁后可能刚被别人生成
         if out_path.exists():
             return RenderResult(gene=gene, out_path=out_path, cache_hit=True)
 
-        # 写入前：缓存配额清理（总量 > 10GB 则删旧文件）
-        prune_cache_if_needed()
-
         _draw(
             library=library,
             gene=gene,
@@ -259,7 +759,10 @@ def ensure_plot_png(
             fmt="png",
             dpi=dpi,
         )
-        return RenderResult(gene=gene, out_path=out_path, cache_hit=False)
+
+    # 缓存配额清理（总量超限则删旧文件）：仅在进程内计数接近上限时后台触发
+    prune_cache_in_background()
+    return RenderResult(gene=gene, out_path=out_path, cache_hit=False)
 
 
 def ensure_export_pdf(
@@ -278,18 +781,17 @@ def ensure_export_pdf(
     gene = _safe_gene(gene)
     library = library or _pick_default_library()
 
-    out_path = cfg.PDF_DIR / f"{library}__{gene}.pdf"
-    lock_path = cfg.LOCK_DIR / f"{library}__{gene}.export_pdf.lock"
+    out_path = _PDF_DIR / f"{library}__{gene}.pdf"
+    lock_path = _lock_path(f"{library}__{gene}.export_pdf")
 
-    if out_path.exists():
+    if _is_cached(lock_path, out_path):
         return RenderResult(gene=gene, out_path=out_path, cache_hit=True)
 
     with _FileLock(lock_path):
+        # 排他锁内用真实 exists()：释放共享锁后可能刚被别人生成
         if out_path.exists():
             return RenderResult(gene=gene, out_path=out_path, cache_hit=True)
 
-        prune_cache_if_needed()
-
         _draw(
             library=library,
             gene=gene,
@@ -299,7 +801,10 @@ def ensure_export_pdf(
             fmt="pdf",
             dpi=None,
         )
-        return RenderResult(gene=gene, out_path=out_path, cache_hit=False)
+
+    # 缓存配额清理（总量超限则删旧文件）：仅在进程内计数接近上限时后台触发
+    prune_cache_in_background()
+    return RenderResult(gene=gene, out_path=out_path, cache_hit=False)
 
 
 def ensure_export_tiff(
@@ -319,25 +824,24 @@ def ensure_export_tiff(
     gene = _safe_gene(gene)
     library = library or _pick_default_library()
 
-    if int(dpi) not in cfg.ALLOWED_EXPORT_DPI:
+    if int(dpi) not in _ALLOWED_EXPORT_DPI:
         raise RenderError(
             "BAD_INPUT",
             "不支持的 dpi 选项。",
-            detail=f"allowed={sorted(list(cfg.ALLOWED_EXPORT_DPI))}, got={dpi}",
+            detail=f"allowed={sorted(list(_ALLOWED_EXPORT_DPI))}, got={dpi}",
         )
 
-    out_path = cfg.TIFF_DIR / f"{library}__{gene}_{int(dpi)}.tiff"
-    lock_path = cfg.LOCK_DIR / f"{library}__{gene}.export_tiff_{int(dpi)}.lock"
+    out_path = _TIFF_DIR / f"{library}__{gene}_{int(dpi)}.tiff"
+    lock_path = _lock_path(f"{library}__{gene}.export_tiff_{int(dpi)}")
 
-    if out_path.exists():
+    if _is_cached(lock_path, out_path):
         return RenderResult(gene=gene, out_path=out_path, cache_hit=True)
 
     with _FileLock(lock_path):
+        # 排他锁内用真实 exists()：释放共享锁后可能刚被别人生成
         if out_path.exists():
             return RenderResult(gene=gene, out_path=out_path, cache_hit=True)
 
-        prune_cache_if_needed()
-
         _draw(
             library=library,
             gene=gene,
@@ -347,4 +851,7 @@ def ensure_export_tiff(
             fmt="tiff",
             dpi=int(dpi),
         )
-        return RenderResult(gene=gene, out_path=out_path, cache_hit=False)
+
+    # 缓存配额清理（总量超限则删旧文件）：仅在进程内计数接近上限时后台触发
+    prune_cache_in_background()
+    return RenderResult(gene=gene, out_path=out_path, cache_hit=False)
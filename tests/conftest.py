@@ -0,0 +1,26 @@
+# tests/conftest.py
+# 测试只针对 app 的子模块（render / cache ...）：
+# - 在任何 app 模块被导入之前，把 DATA_DIR / FIG_DIR / LOG_DIR 指到临时目录，不在仓库里建目录
+# - 把 app 注册成一个不执行 app/__init__ 的空包：__init__ 会导入 main（FastAPI 应用、
+#   挂载 static、cfg.ensure_runtime()），这些与被测代码无关
+from __future__ import annotations
+
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import types
+from pathlib import Path
+
+_ROOT = Path(__file__).resolve().parents[1]
+_TMP = Path(tempfile.mkdtemp(prefix="spatial-website-tests-"))
+atexit.register(shutil.rmtree, _TMP, ignore_errors=True)
+
+for _name in ("DATA_DIR", "FIG_DIR", "LOG_DIR"):
+    os.environ[_name] = str(_TMP / _name.lower())
+
+if "app" not in sys.modules:
+    _pkg = types.ModuleType("app")
+    _pkg.__path__ = [str(_ROOT / "app")]
+    sys.modules["app"] = _pkg
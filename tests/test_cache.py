@@ -0,0 +1,135 @@
+# tests/test_cache.py
+# prune_cache_if_needed：按 mtime 淘汰到低水位、keep_newest、进程内计数的快速路径。
+from __future__ import annotations
+
+import os
+
+import pytest
+
+from app import cache
+
+SIZE = 100
+
+
+@pytest.fixture
+def files(tmp_path):
+    """10 个 100 字节的文件，分在两层目录里；f0 最旧，f9 最新。"""
+    paths = []
+    for i in range(10):
+        p = tmp_path / ("sub" if i % 2 else "") / f"f{i}.png"
+        p.parent.mkdir(exist_ok=True)
+        p.write_bytes(b"x" * SIZE)
+        os.utime(p, (1_000_000 + i, 1_000_000 + i))
+        paths.append(p)
+    return paths
+
+
+@pytest.fixture
+def fresh_counter(tmp_path, monkeypatch):
+    """进程内计数从未初始化开始，锁目录与默认缓存目录指到临时目录，并统计 _scan 次数。"""
+    monkeypatch.setattr(cache, "_approx_bytes", None)
+    monkeypatch.setattr(cache, "_writes_since_scan", 0)
+    monkeypatch.setattr(cache, "_LOCK_DIR", tmp_path / "locks")
+    monkeypatch.setattr(cache, "_CACHE_DIRS", [tmp_path])
+    scans = []
+    real_scan = cache._scan
+
+    def _counting_scan(dirs):
+        scans.append(1)
+        return real_scan(dirs)
+
+    monkeypatch.setattr(cache, "_scan", _counting_scan)
+    return scans
+
+
+def _survivors(paths):
+    return [p.name for p in paths if p.exists()]
+
+
+def test_under_quota_deletes_nothing(files, tmp_path, fresh_counter):
+    r = cache.prune_cache_if_needed(max_bytes=10 * SIZE, dirs=[tmp_path])
+    assert (r.before_bytes, r.after_bytes, r.deleted_files) == (1000, 1000, 0)
+    assert len(_survivors(files)) == 10
+
+
+def test_prunes_oldest_down_to_low_watermark(files, tmp_path, fresh_counter):
+    # 上限 500，低水位 475：要删到 400（保留最新 4 个），而不是刚好压线的 500
+    r = cache.prune_cache_if_needed(max_bytes=5 * SIZE, dirs=[tmp_path])
+    assert r.before_bytes == 1000
+    assert r.after_bytes == 400
+    assert (r.deleted_files, r.deleted_bytes) == (6, 600)
+    assert not r.skipped_due_to_lock
+    assert _survivors(files) == ["f6.png", "f7.png", "f8.png", "f9.png"]
+
+
+def test_keep_newest_is_never_deleted(files, tmp_path, fresh_counter):
+    r = cache.prune_cache_if_needed(max_bytes=5 * SIZE, dirs=[tmp_path], keep_newest=8)
+    assert r.after_bytes == 800
+    assert r.deleted_files == 2
+    assert _survivors(files) == [f"f{i}.png" for i in range(2, 10)]
+
+
+def test_small_unlink_batches_reach_the_same_result(files, tmp_path, fresh_counter, monkeypatch):
+    monkeypatch.setattr(cache, "_UNLINK_BATCH", 2)
+    r = cache.prune_cache_if_needed(max_bytes=5 * SIZE, dirs=[tmp_path])
+    assert r.after_bytes == 400
+    assert _survivors(files) == ["f6.png", "f7.png", "f8.png", "f9.png"]
+
+
+def test_skips_when_another_pruner_holds_the_lock(files, tmp_path, fresh_counter):
+    fd = cache._acquire_prune_lock(tmp_path / "locks" / "_prune.lock")
+    assert fd is not None
+    try:
+        r = cache.prune_cache_if_needed(max_bytes=5 * SIZE, dirs=[tmp_path])
+        assert r.skipped_due_to_lock
+        assert r.after_bytes == r.before_bytes == 1000
+        assert len(_survivors(files)) == 10
+    finally:
+        cache._release_prune_lock(fd)
+    # 锁释放后即可清理（锁文件常驻不影响）
+    assert not cache.prune_cache_if_needed(max_bytes=5 * SIZE, dirs=[tmp_path]).skipped_due_to_lock
+
+
+def test_counter_skips_scan_below_quota(tmp_path, fresh_counter):
+    scans = fresh_counter
+
+    # 未初始化：第一次必须扫描，之后计数即与磁盘同步
+    cache.prune_cache_if_needed(max_bytes=1000)
+    assert len(scans) == 1
+
+    cache._sync_approx(500)
+    for _ in range(4):
+        cache.record_write(tmp_path / "new.png", size=100)
+    r = cache.prune_cache_if_needed(max_bytes=1000)
+    assert len(scans) == 1
+    assert r.before_bytes == 900
+
+    # 超过上限才重新扫描
+    cache.record_write(tmp_path / "big.png", size=200)
+    cache.prune_cache_if_needed(max_bytes=1000)
+    assert len(scans) == 2
+
+
+def test_counter_resyncs_after_many_writes(tmp_path, fresh_counter, monkeypatch):
+    scans = fresh_counter
+    monkeypatch.setattr(cache, "_RESYNC_EVERY_WRITES", 3)
+    cache._sync_approx(0)
+
+    for _ in range(2):
+        cache.record_write(tmp_path / "new.png", size=1)
+    cache.prune_cache_if_needed(max_bytes=1000)
+    assert len(scans) == 0
+
+    cache.record_write(tmp_path / "new.png", size=1)
+    r = cache.prune_cache_if_needed(max_bytes=1000)
+    assert len(scans) == 1
+    # 校正后以磁盘为准（这些文件并不存在）
+    assert r.before_bytes == 0
+    cache.prune_cache_if_needed(max_bytes=1000)
+    assert len(scans) == 1
+
+
+def test_prune_updates_counter(files, tmp_path, fresh_counter):
+    r = cache.prune_cache_if_needed(max_bytes=5 * SIZE)
+    assert r.after_bytes == 400
+    assert cache._fresh_approx() == 400
@@ -0,0 +1,120 @@
+# tests/test_render_h5.py
+# h5py 直读路径（_read_minimal_*）与 anndata 读出的结果必须一致。
+from __future__ import annotations
+
+import pytest
+
+np = pytest.importorskip("numpy")
+h5py = pytest.importorskip("h5py")
+sparse = pytest.importorskip("scipy.sparse")
+pd = pytest.importorskip("pandas")
+ad = pytest.importorskip("anndata")
+pytest.importorskip("scanpy")  # _import_plot_deps 会一并导入
+
+from app import config as cfg  # noqa: E402
+from app import render  # noqa: E402
+
+LIB = "libA"
+N_OBS, N_VARS = 53, 6
+
+
+def _matrix(rng, n_obs: int, n_vars: int):
+    m = rng.random((n_obs, n_vars)).astype(np.float32)
+    m[m < 0.6] = 0  # 稀疏一些，且保证有全零的行 / 列片段
+    m[:, 2] = 0
+    return m
+
+
+@pytest.fixture
+def h5ad(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    dense = _matrix(rng, N_OBS, N_VARS)
+    raw = _matrix(rng, N_OBS, N_VARS + 2)
+
+    obs = pd.DataFrame(
+        {"library": pd.Categorical([LIB if i % 3 else "libB" for i in range(N_OBS)])},
+        index=[f"c{i}" for i in range(N_OBS)],
+    )
+    var = pd.DataFrame(index=[f"g{j}" for j in range(N_VARS)])
+    raw_var = pd.DataFrame(index=[f"g{j}" for j in range(N_VARS)] + ["raw_only0", "raw_only1"])
+
+    adata = ad.AnnData(
+        X=sparse.csr_matrix(dense),
+        obs=obs,
+        var=var,
+        obsm={"spatial": rng.random((N_OBS, 2)).astype(np.float32) * 100},
+        layers={
+            "dense": dense * 2,
+            "csc": sparse.csc_matrix(dense * 3),
+            "csr": sparse.csr_matrix(dense * 4),
+        },
+    )
+    adata.raw = ad.AnnData(X=sparse.csr_matrix(raw), obs=obs, var=raw_var)
+    adata.write_h5ad(tmp_path / f"{LIB}.h5ad")
+
+    render._import_plot_deps()
+    monkeypatch.setattr(cfg, "DATA_DIR", tmp_path)
+    # 块比行数小，覆盖 CSR 跨块扫描
+    monkeypatch.setattr(render, "_CSR_BLOCK_ROWS", 7)
+    render._h5_var_index.cache_clear()
+    yield ad.read_h5ad(tmp_path / f"{LIB}.h5ad")
+    render._h5_var_index.cache_clear()
+
+
+def _col(m, j: int):
+    m = m[:, j]
+    return np.asarray(m.toarray() if sparse.issparse(m) else m, dtype=np.float32).ravel()
+
+
+@pytest.mark.parametrize("layer", ["X", "dense", "csc", "csr"])
+def test_gene_column_matches_anndata(h5ad, layer):
+    m = h5ad.X if layer == "X" else h5ad.layers[layer]
+    for j, gene in enumerate(h5ad.var_names):
+        got = render._read_minimal_gene(LIB, gene, layer, 0)
+        np.testing.assert_array_equal(got, _col(m, j))
+
+
+def test_raw_only_gene_reads_raw_x(h5ad):
+    for gene in ("raw_only0", "raw_only1"):
+        j = h5ad.raw.var_names.get_loc(gene)
+        got = render._read_minimal_gene(LIB, gene, "X", 0)
+        np.testing.assert_array_equal(got, _col(h5ad.raw.X, j))
+
+
+def test_default_library_from_data_dir(h5ad, monkeypatch):
+    monkeypatch.delenv("DEFAULT_LIB", raising=False)
+    assert render._pick_default_library() == LIB
+    assert render._adata_path(LIB).parent == cfg.DATA_DIR
+
+
+def test_unknown_gene_falls_back(h5ad):
+    with pytest.raises(render._MinimalReadUnsupported):
+        render._read_minimal_gene(LIB, "library", "X", 0)
+
+
+def test_coords_and_library_mask(h5ad):
+    xy, mask = render._read_minimal_coords(LIB, "spatial")
+    np.testing.assert_array_equal(xy, h5ad.obsm["spatial"][:, :2].astype(np.float32))
+    np.testing.assert_array_equal(mask, (h5ad.obs["library"] == LIB).to_numpy())
+
+
+def test_library_mask_legacy_formats(tmp_path):
+    render._import_plot_deps()
+    labels = np.array([LIB, "libB", LIB, "libB", "libB"])
+    expected = labels == LIB
+    str_dt = h5py.string_dtype()
+
+    # 旧版 categorical：codes 数据集 + attrs["categories"] 指向 obs/__categories
+    with h5py.File(tmp_path / "old.h5", "w") as f:
+        cats = f.create_dataset("obs/__categories/library", data=np.array(["libB", LIB], dtype=object), dtype=str_dt)
+        codes = f.create_dataset("obs/library", data=np.where(expected, 1, 0).astype(np.int8))
+        codes.attrs["categories"] = cats.ref
+    with h5py.File(tmp_path / "old.h5", "r") as f:
+        np.testing.assert_array_equal(render._h5_library_mask(f, LIB), expected)
+        assert not render._h5_library_mask(f, "missing").any()
+
+    # 普通字符串列
+    with h5py.File(tmp_path / "str.h5", "w") as f:
+        f.create_dataset("obs/library", data=labels.astype(object), dtype=str_dt)
+    with h5py.File(tmp_path / "str.h5", "r") as f:
+        np.testing.assert_array_equal(render._h5_library_mask(f, LIB), expected)
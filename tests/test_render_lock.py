@@ -0,0 +1,104 @@
+# tests/test_render_lock.py
+# _FileLock / _flock_wait：排他超时、读写互斥、超时放弃后 fd 不泄漏。
+from __future__ import annotations
+
+import os
+import threading
+import time
+
+import pytest
+
+from app import render
+
+
+def _open_fds() -> int:
+    return len(os.listdir("/proc/self/fd"))
+
+
+def _wait_until(cond, timeout_s: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        if cond():
+            return True
+        time.sleep(0.01)
+    return cond()
+
+
+def test_contended_exclusive_lock_times_out(tmp_path):
+    path = tmp_path / "locks" / "a.lock"  # 目录不存在：同时覆盖兜底 mkdir
+    holder = render._FileLock(path)
+    holder.acquire()
+    try:
+        t0 = time.monotonic()
+        with pytest.raises(render.RenderError) as ei:
+            render._FileLock(path, timeout_s=0.2).acquire()
+        assert ei.value.code == "LOCK_TIMEOUT"
+        assert time.monotonic() - t0 >= 0.2
+    finally:
+        holder.release()
+
+
+def test_shared_readers_coexist(tmp_path):
+    path = tmp_path / "a.lock"
+    a, b = render._FileLock(path, timeout_s=0.2), render._FileLock(path, timeout_s=0.2)
+    a.acquire_shared()
+    b.acquire_shared()
+    with pytest.raises(render.RenderError):
+        render._FileLock(path, timeout_s=0.2).acquire()
+    a.release()
+    b.release()
+
+
+def test_shared_reader_waits_for_writer(tmp_path):
+    path = tmp_path / "a.lock"
+    writer = render._FileLock(path)
+    writer.acquire()
+
+    acquired = threading.Event()
+    reader = render._FileLock(path, timeout_s=5.0)
+
+    def _read() -> None:
+        reader.acquire_shared()
+        acquired.set()
+
+    t = threading.Thread(target=_read)
+    t.start()
+    try:
+        assert not acquired.wait(0.3)
+    finally:
+        writer.release()
+    assert acquired.wait(5.0)
+    t.join(5.0)
+    reader.release()
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc/self/fd")
+def test_timeout_does_not_leak_fds(tmp_path):
+    path = tmp_path / "a.lock"
+    before = _open_fds()
+
+    holder = render._FileLock(path)
+    holder.acquire()
+    for _ in range(5):
+        with pytest.raises(render.RenderError):
+            render._FileLock(path, timeout_s=0.05).acquire()
+        with pytest.raises(render.RenderError):
+            render._FileLock(path, timeout_s=0.05).acquire_shared()
+    holder.release()
+
+    # 被放弃的等待线程拿到锁后立即关闭自己的 fd
+    assert _wait_until(lambda: _open_fds() == before)
+
+    # 锁也随之真正释放：新的排他锁可以立即拿到
+    lock = render._FileLock(path, timeout_s=1.0)
+    lock.acquire()
+    lock.release()
+    assert _open_fds() == before
+
+
+def test_lock_path_is_striped_and_stable():
+    a = render._lock_path("sham__Gfap.plot_png")
+    assert a == render._lock_path("sham__Gfap.plot_png")
+    assert a.parent == render._LOCK_DIR
+    names = {render._lock_path(f"sham__g{i}.plot_png").name for i in range(5000)}
+    assert len(names) <= render._LOCK_STRIPES